@@ -3,15 +3,25 @@
 A script to fetch the current player count in steam for a given game query
 """
 import asyncio
+import bisect
+import functools
+import gzip
+import heapq
 import json
 import os
 import re
+import shutil
 import sys
 import tempfile
 import time
+from array import array
 
 import click
+import httpx
+import ijson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 if sys.version_info[0] < 3:
     raise Exception("Script requires Python 3.x")
@@ -23,166 +33,401 @@ PLAYER_COUNT_URL = BASE_URL + "ISteamUserStats/GetNumberOfCurrentPlayers/v1/"
 
 # LOCAL FILES
 TEMP_DATA_DIR = os.path.join(tempfile.gettempdir(), "steam_scripts", "data")
-APP_LIST_FILE = os.path.join(TEMP_DATA_DIR, "app_list.json")
+APP_LIST_FILE = os.path.join(TEMP_DATA_DIR, "app_list.json.gz")
+APP_LIST_ETAG_FILE = os.path.join(TEMP_DATA_DIR, "app_list.etag")
+# search index columns, kept as plain data files so loading them can never
+# run code planted in the shared temp directory
+APP_INDEX_IDS_FILE = os.path.join(TEMP_DATA_DIR, "app_index_ids.bin")
+APP_INDEX_NAMES_FILE = os.path.join(TEMP_DATA_DIR, "app_index_names.json")
+APP_INDEX_BLOB_FILE = os.path.join(TEMP_DATA_DIR, "app_index_blob.txt")
+APP_INDEX_OFFSETS_FILE = os.path.join(TEMP_DATA_DIR, "app_index_offsets.bin")
+PLAYER_CACHE_FILE = os.path.join(TEMP_DATA_DIR, "player_cache.json")
+
+# re-validate the cached app list with steam after this many seconds
+APP_LIST_TTL = 24 * 60 * 60
+# reuse fetched player counts for this many seconds
+PLAYER_CACHE_TTL = 60
+
+# REQUEST LIMITS
+MAX_CONCURRENT_REQUESTS = 32
+# total tries per request, including the first one
+MAX_ATTEMPTS = 3
 
 PRINT_LIST = False
 
+# shared session so blocking requests reuse a keep-alive connection, it only
+# makes one request at a time so the adapter's default pool sizes are plenty.
+# urllib3 counts retries after the first try, hence MAX_ATTEMPTS - 1
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(max_retries=Retry(total=MAX_ATTEMPTS - 1,
+                                  backoff_factor=0.3,
+                                  status_forcelist=[500, 502, 503])))
+
+
+def write_file_atomic(path, data):
+    """
+    Write bytes to path through a temp file that is swapped in, so readers
+    (and overlapping runs) never see a partially written file
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out_file:
+            out_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
 
 def get_app_list():
-    """ Save app catalog as app_list.json """
-    res = requests.get(APP_LIST_URL)
+    """
+    Save gzipped app catalog as app_list.json.gz and build its index, returns
+    False if steam reports the cached copy is still current
+    """
+    headers = {}
+    if os.path.exists(APP_LIST_FILE) and os.path.exists(APP_LIST_ETAG_FILE):
+        with open(APP_LIST_ETAG_FILE, "r", encoding="utf-8") as etag_file:
+            headers["If-None-Match"] = etag_file.read().strip()
+
+    res = SESSION.get(APP_LIST_URL, headers=headers)
     res.raise_for_status()
 
-    while res.json() is None:
+    # steam sometimes answers with a null body while the list is being built,
+    # check for that without decoding the whole catalog
+    while res.status_code != 304 and res.content.strip() in (b"", b"null"):
         time.sleep(1)
-        res = requests.get(APP_LIST_URL)
+        res = SESSION.get(APP_LIST_URL, headers=headers)
+
+    if res.status_code == 304:
+        # touch the file so the TTL starts over
+        os.utime(APP_LIST_FILE)
+        return False
+
+    # the catalog is tens of MB of plain json, compress it on disk. it goes
+    # to a temp file first and only replaces the cached copy once an index
+    # has been built from it, so a bad download never clobbers a good one
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(APP_LIST_FILE),
+                                     suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out_file:
+            out_file.write(gzip.compress(res.content, compresslevel=6))
+        build_app_index(temp_path)
+        os.replace(temp_path, APP_LIST_FILE)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    etag = res.headers.get("ETag")
+    if etag:
+        write_file_atomic(APP_LIST_ETAG_FILE, etag.encode("utf-8"))
+    elif os.path.exists(APP_LIST_ETAG_FILE):
+        os.remove(APP_LIST_ETAG_FILE)
+
+    return True
+
+
+def app_list_expired():
+    """ Check if app_list.json.gz is missing or older than APP_LIST_TTL """
+    if not os.path.exists(APP_LIST_FILE):
+        return True
+    return time.time() - os.path.getmtime(APP_LIST_FILE) > APP_LIST_TTL
 
-    with open(APP_LIST_FILE, "w", encoding="utf-8") as out_file:
-        out_file.write(res.text)
 
+def build_app_index(app_list_file=None):
+    """
+    Save parallel id/name columns plus a newline separated blob of lowercased
+    names (and the offset where each name starts in it) as the app_index_*
+    files, raises ValueError if app_list_file isn't a usable catalog
+    """
+    if app_list_file is None:
+        app_list_file = APP_LIST_FILE
+
+    app_ids = array("i")
+    app_names = []
+    app_names_lower = []
+    name_offsets = array("q")
+    offset = 0
+
+    # stream the catalog so only one app dict is alive at a time
+    try:
+        with gzip.open(app_list_file, "rb") as list_file:
+            for game_dict in ijson.items(list_file, "applist.apps.item"):
+                # newlines separate rows in the blob so they can't be in a
+                # name
+                name_lower = game_dict["name"].lower().replace("\n", " ")
+                app_ids.append(game_dict["appid"])
+                app_names.append(game_dict["name"])
+                app_names_lower.append(name_lower)
+                name_offsets.append(offset)
+                offset += len(name_lower) + 1
+    except (ijson.JSONError, KeyError, TypeError, AttributeError) as e:
+        raise ValueError("Invalid app list: {}".format(e)) from e
+
+    if not app_ids:
+        raise ValueError("Invalid app list: no apps found")
+
+    name_offsets.append(offset)
+    names_blob = "\n".join(app_names_lower)
+
+    write_file_atomic(APP_INDEX_IDS_FILE, app_ids.tobytes())
+    write_file_atomic(APP_INDEX_NAMES_FILE,
+                      json.dumps(app_names).encode("utf-8"))
+    write_file_atomic(APP_INDEX_BLOB_FILE, names_blob.encode("utf-8"))
+    write_file_atomic(APP_INDEX_OFFSETS_FILE, name_offsets.tobytes())
+
+
+@functools.lru_cache(maxsize=None)
+def load_app_index():
+    """
+    Load the (app_ids, app_names, names_blob, name_offsets) columns once per
+    run
+    """
+    app_ids = array("i")
+    with open(APP_INDEX_IDS_FILE, "rb") as index_file:
+        app_ids.frombytes(index_file.read())
+    with open(APP_INDEX_NAMES_FILE, "r", encoding="utf-8") as index_file:
+        app_names = json.load(index_file)
+    with open(APP_INDEX_BLOB_FILE, "r", encoding="utf-8",
+              newline="") as index_file:
+        names_blob = index_file.read()
+    name_offsets = array("q")
+    with open(APP_INDEX_OFFSETS_FILE, "rb") as index_file:
+        name_offsets.frombytes(index_file.read())
+
+    # the columns are swapped in one at a time, so make sure they all came
+    # from the same build
+    if not (len(app_ids) == len(app_names) == len(name_offsets) - 1
+            and name_offsets[-1] == len(names_blob) + bool(app_names)):
+        raise ValueError("App index columns are inconsistent")
+
+    return app_ids, app_names, names_blob, name_offsets
+
+
+def load_player_cache():
+    """
+    Load the {app_id: [players, timestamp]} cache, dropping stale entries
+    """
+    now = time.time()
 
-async def get_player_counts(app_ids, app_players):
-    """ Asynchronously request player count from a list of app_ids """
-    loop = asyncio.get_event_loop()
-    futures = []
+    # the cache is optional, anything unreadable or malformed counts as empty
+    try:
+        with open(PLAYER_CACHE_FILE, "r", encoding="utf-8") as cache_file:
+            cache = json.load(cache_file)
 
-    for app_id in app_ids:
-        futures.append(
-            loop.run_in_executor(None, requests.get,
-                                 PLAYER_COUNT_URL + "?appid=" + str(app_id)))
+        return {
+            int(app_id): [int(entry[0]), float(entry[1])]
+            for app_id, entry in cache.items()
+            if now - float(entry[1]) <= PLAYER_CACHE_TTL
+        }
+    except (OSError, ValueError, TypeError, IndexError, KeyError,
+            AttributeError):
+        return {}
 
-    for response in await asyncio.gather(*futures):
-        try:
-            app_players.append(response.json()["response"]["player_count"])
-        except KeyError:
-            app_players.append(0)
+
+def save_player_cache(cache):
+    """ Save the {app_id: [players, timestamp]} cache as player_cache.json """
+    write_file_atomic(PLAYER_CACHE_FILE, json.dumps(cache).encode("utf-8"))
 
 
-def get_apps_info(search_string, fuzzy_match):
+async def get_player_counts(app_ids):
     """
-    Search app_list for the search_string and return relevant data in a tuple
-    with 3 members
+    Asynchronously request player count from a list of app_ids, yielding
+    (app_id, players) tuples as each response arrives, counts fetched in
+    the last PLAYER_CACHE_TTL seconds are served from player_cache.json
     """
-    with open(APP_LIST_FILE, "r", encoding="utf-8") as list_file:
-        json_dict = json.loads(list_file.read())
-        app_list = json_dict["applist"]["apps"]
+    cache = load_player_cache()
+    to_fetch = []
 
-        # initialize parallel lists
-        found_app_ids = []
-        found_app_names = []
-        found_app_players = []
-
-        for game_dict in app_list:
-            app_id = game_dict["appid"]
-            app_name = game_dict["name"]
-
-            if fuzzy_match:
-                from fuzzywuzzy import fuzz
-
-                if fuzz.partial_ratio(app_name.lower(),
-                                      search_string.lower()) >= 85:
-                    found_app_ids.append(app_id)
-                    found_app_names.append(app_name)
+    for app_id in app_ids:
+        if app_id in cache:
+            yield app_id, cache[app_id][0]
+        else:
+            to_fetch.append(app_id)
+
+    if not to_fetch:
+        return
+
+    # keep the semaphore and connection limit in step so steam doesn't
+    # throttle us with 500s, and so requests never wait on the pool if the
+    # server falls back to http/1.1 (http/2 just multiplexes them instead)
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limits = httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS,
+                          max_keepalive_connections=MAX_CONCURRENT_REQUESTS)
+
+    async with httpx.AsyncClient(http2=True, limits=limits) as client:
+
+        async def fetch(app_id):
+            for attempt in range(MAX_ATTEMPTS):
+                try:
+                    async with sem:
+                        response = await client.get(PLAYER_COUNT_URL,
+                                                    params={"appid": app_id})
+                    # unknown app ids come back as 404, no point retrying
+                    if response.status_code == 404:
+                        return app_id, 0
+                    response.raise_for_status()
+                    data = json.loads(response.content)
+                    stats = (data.get("response")
+                             if isinstance(data, dict) else None)
+                    if not isinstance(stats, dict):
+                        raise ValueError("Malformed player count response")
+                    players = stats.get("player_count", 0)
+                    if not isinstance(players, int):
+                        raise ValueError("Malformed player count response")
+                    return app_id, players
+                except (httpx.HTTPError, ValueError):
+                    if attempt == MAX_ATTEMPTS - 1:
+                        print("Failed to get player count for app", app_id,
+                              file=sys.stderr)
+                        return app_id, None
+                    await asyncio.sleep(2**attempt)
+
+        for future in asyncio.as_completed([fetch(a) for a in to_fetch]):
+            app_id, players = await future
+            # don't cache failed requests, they're reported as 0 players
+            if players is None:
+                players = 0
             else:
-                pattern = re.compile(re.escape(search_string.lower()))
-                if pattern.search(app_name.lower()):
-                    found_app_ids.append(app_id)
-                    found_app_names.append(app_name)
+                cache[app_id] = [players, time.time()]
+            yield app_id, players
+
+    save_player_cache(cache)
 
-        print("Number of Apps Matching Search:", len(found_app_ids))
 
-    # request players asynchronously from steam api
-    if sys.version_info[1] >= 7:
-        asyncio.run(get_player_counts(found_app_ids, found_app_players))
+async def get_top_apps(matches, num_rows):
+    """
+    Request player counts for (app_id, app_name) matches and return the
+    num_rows most played as (players, app_id, app_name) tuples
+    """
+    app_names = dict(matches)
+    # min-heap of the best rows so far, only num_rows are ever kept
+    top_apps = []
+    # only redraw a progress line when someone is watching the terminal
+    show_progress = sys.stderr.isatty()
+    done = 0
+    leader = None
+    line = ""
+
+    async for app_id, players in get_player_counts(app_names):
+        row = (players, app_id, app_names[app_id])
+        if len(top_apps) < num_rows:
+            heapq.heappush(top_apps, row)
+        else:
+            heapq.heappushpop(top_apps, row)
+
+        if show_progress:
+            done += 1
+            if leader is None or row > leader:
+                leader = row
+            width = os.get_terminal_size(sys.stderr.fileno()).columns - 1
+            line = (f"Fetched {done}/{len(app_names)} player counts, most "
+                    f"played so far: {leader[2]} ({leader[0]:,})")[:width]
+            print("\r" + line.ljust(width), end="", file=sys.stderr,
+                  flush=True)
+
+    if line:
+        # clear the progress line before the table is printed
+        print("\r" + " " * len(line) + "\r", end="", file=sys.stderr,
+              flush=True)
+
+    return sorted(top_apps, reverse=True)
+
+
+def search_apps(search_strings, fuzzy_match):
+    """ Yield (app_id, app_name) for every app matching any search_string """
+    app_ids, app_names, names_blob, name_offsets = load_app_index()
+    # drop repeated queries, keeping the order they were given in
+    search_strings = list(dict.fromkeys(s.lower() for s in search_strings))
+
+    if fuzzy_match:
+        from fuzzywuzzy import fuzz
+
+        for i, name_lower in enumerate(names_blob.split("\n")):
+            if any(
+                    fuzz.partial_ratio(name_lower, s) >= 85
+                    for s in search_strings):
+                yield app_ids[i], app_names[i]
     else:
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(
-            get_player_counts(found_app_ids, found_app_players))
+        search_strings = [s.replace("\n", " ") for s in search_strings]
+
+        # a query containing a shorter query can never add a match
+        search_strings = [
+            s for s in search_strings
+            if not any(o != s and o in s for o in search_strings)
+        ]
+
+        # one alternation pattern matches every query, and running it over
+        # the whole blob keeps the scan in C instead of looping per name
+        pattern = re.compile("|".join(map(re.escape, search_strings)))
+        pos = 0
+
+        while pos <= len(names_blob):
+            match = pattern.search(names_blob, pos)
+            if match is None:
+                break
+            i = bisect.bisect_right(name_offsets, match.start()) - 1
+            yield app_ids[i], app_names[i]
+            # resume at the next name so each app is yielded once
+            pos = name_offsets[i + 1]
+
+
+def get_apps_info(search_strings, fuzzy_match, num_rows):
+    """
+    Search app_list for any of the search_strings and return the num_rows
+    most played matches as (players, app_id, app_name) tuples
+    """
+    matches = list(search_apps(search_strings, fuzzy_match))
 
-    return (found_app_ids, found_app_names, found_app_players)
+    print("Number of Apps Matching Search:", len(matches))
 
+    # request players asynchronously from steam api, every query shares this
+    # one event loop and http client
+    return asyncio.run(get_top_apps(matches, num_rows))
 
-def print_player_table(found_app_ids, found_app_names, found_app_players,
-                       num_rows):
+
+def print_player_table(top_apps):
     """ Print table of player stats """
-    if not found_app_ids:
+    if not top_apps:
         print("No App ID's found with search term", file=sys.stderr)
         sys.exit()
-    elif not found_app_names:
-        print("No App Names found with search term", file=sys.stderr)
-        sys.exit()
-
-    # zip lists for sorting
-    zipped = zip(found_app_players, found_app_ids, found_app_names)
-    zipped = sorted(zipped)
-
-    # convert back to lists
-    found_app_ids = [i for (p, i, n) in zipped]
-    found_app_names = [n for (p, i, n) in zipped]
-    found_app_players = [p for (p, i, n) in zipped]
 
-    display_app_ids = []
-    display_app_names = []
-    display_app_players = []
+    print("Number of Apps Displayed:", len(top_apps))
 
-    for n in range(len(found_app_ids)):
-        if n >= num_rows:
-            break
-        display_app_ids.append(found_app_ids.pop())
-        display_app_names.append(found_app_names.pop())
-        display_app_players.append(found_app_players.pop())
-
-    print("Number of Apps Displayed:", num_rows)
-
-    w = int(os.get_terminal_size().columns)
+    # names and separators are capped at 1/3 of the screen width
+    max_width = os.get_terminal_size().columns // 3
 
     if PRINT_LIST:
         # print in list format
-        print("-" * int(w / 3))
-        for id, name, players in zip(display_app_ids, display_app_names,
-                                     display_app_players):
-            print("{:10}{id}\n{:10}{name}\n{:10}{players}".format(
-                "App ID:",
-                "Name:",
-                "Players:",
-                id=id,
-                name=name,
-                players=players))
-            print("-" * int(w / 3))
+        sep = "-" * max_width
+        print(sep)
+        for players, app_id, name in top_apps:
+            print(f"{'App ID:':10}{app_id}\n{'Name:':10}{name}\n"
+                  f"{'Players:':10}{players}")
+            print(sep)
     else:
         # print in table format
-        longest_name_width = len(max(display_app_names, key=len))
-        # make sure the longest name is not more than 1/3 of the screen width
-        if longest_name_width > int(w / 3):
-            longest_name_width = int(w / 3)
+        longest_name_width = min(max(len(n) for p, i, n in top_apps),
+                                 max_width)
 
         # header formatting
-        header = "| {id:<10} | {name:<{mid_space}} | {players:<10} |".format(
-            id="ID",
-            name="App Name",
-            players="Players",
-            mid_space=longest_name_width)
+        header = (f"| {'ID':<10} | {'App Name':<{longest_name_width}} | "
+                  f"{'Players':<10} |")
+        sep = "-" * len(header)
+        header_block = "\n".join((sep, header, sep))
 
         # print out table header
-        print("-" * len(header))
-        print(header)
-        print("-" * len(header))
+        print(header_block)
 
         # print rows
-        for id, name, players in zip(display_app_ids, display_app_names,
-                                     display_app_players):
-            row = "| {id:<10} | {name:<{mid_space}} | {players:<10,} |".format(
-                id=id,
-                name=name[:longest_name_width],
-                players=players,
-                mid_space=longest_name_width,
-            )
-            print(row)
+        for players, app_id, name in top_apps:
+            print(f"| {app_id:<10} | "
+                  f"{name[:longest_name_width]:<{longest_name_width}} | "
+                  f"{players:<10,} |")
 
         # print out table header again (for long output)
-        print("-" * len(header))
-        print(header)
-        print("-" * len(header))
+        print(header_block)
 
 
 @click.command()
@@ -208,23 +453,44 @@ def print_player_table(found_app_ids, found_app_names, found_app_players,
     help="Use Levenshtein fuzzy matching on query",
 )
 @click.option("--num-rows", "-n", type=click.INT, default=10, required=False)
-@click.argument("query")
+@click.argument("query", nargs=-1, required=True)
 def main(clear_cache, list_format, num_rows, query, fuzzy_match):
     if clear_cache:
-        os.removedirs(TEMP_DATA_DIR)
+        shutil.rmtree(TEMP_DATA_DIR, ignore_errors=True)
 
     if not os.path.exists(TEMP_DATA_DIR):
         os.makedirs(TEMP_DATA_DIR, exist_ok=True)
 
-    if not os.path.exists(APP_LIST_FILE):
-        get_app_list()
+    if app_list_expired():
+        try:
+            get_app_list()
+        except (requests.RequestException, ValueError) as e:
+            # a stale catalog is still usable, only a missing one is fatal
+            if not os.path.exists(APP_LIST_FILE):
+                raise
+            print("Could not refresh app list, using cached copy:", e,
+                  file=sys.stderr)
+
+    try:
+        load_app_index()
+    except (OSError, ValueError):
+        # missing, partially written or mixed up index, build it again
+        build_app_index()
+
+    # uvloop is optional (and unavailable on windows), asyncio.run picks it up
+    try:
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        pass
 
     if list_format:
         global PRINT_LIST
         PRINT_LIST = True
 
-    apps_info = get_apps_info(query, fuzzy_match)
-    print_player_table(apps_info[0], apps_info[1], apps_info[2], num_rows)
+    top_apps = get_apps_info(query, fuzzy_match, num_rows)
+    print_player_table(top_apps)
 
 
 if __name__ == "__main__":